@@ -2,17 +2,19 @@ import os
 import numpy as np
 import torch
 import json
+import orjson
 import argparse
-import random
 from transformers import (
     AutoTokenizer,
     DataCollatorForSeq2Seq,
     Seq2SeqTrainingArguments,
-    Seq2SeqTrainer,
     T5ForConditionalGeneration,
     EarlyStoppingCallback,
+    set_seed,
 )
 from utils_data import load_dataset_std, DatasetStd
+from utils_trainer import RecTrainer
+from utils_model import enable_sdpa_attention
 from utils_evaluate import caculate, get_scores
 from rich.table import Column, Table
 from rich import box
@@ -22,6 +24,12 @@ console = Console(record=True)
 import nltk
 import evaluate
 
+# let the rust tokenizer decode on all cores. Forcing this disables the
+# library's fork safety, which is fine only because the dataloader workers
+# just slice pre-tokenized ids and collate with tokenizer.pad, which is pure
+# python and never calls the rust backend
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -31,9 +39,20 @@ def parse_args():
     parser.add_argument("--epoch", type=int, default=20)
     parser.add_argument("--lr", type=float, default=5e-5)
     parser.add_argument("--bs", type=int, default=16)
+    parser.add_argument(
+        "--grad_acc", type=int, default=1, help="gradient accumulation step"
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="recompute activations in backward to fit a larger --bs",
+    )
     parser.add_argument("--input_len", type=int, default=1024)
     parser.add_argument("--output_len", type=int, default=128)
     parser.add_argument("--eval_bs", type=int, default=16)
+    parser.add_argument(
+        "--num_beams", type=int, default=1, help="beam width for generation"
+    )
     parser.add_argument(
         "--eval_acc", type=int, default=None, help="evaluate accumulation step"
     )
@@ -55,6 +74,18 @@ def parse_args():
         action="store_true",
         help="only for baseline to improve inference speed",
     )
+    parser.add_argument(
+        "--attn_implementation",
+        type=str,
+        default="sdpa",
+        help="T5 attention kernel, sdpa needs torch>=2.1",
+        choices=["eager", "sdpa"],
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="compile the model with torch.compile (requires torch>=2.0)",
+    )
     parser.add_argument(
         "--final_eval",
         action="store_true",
@@ -80,6 +111,11 @@ def parse_args():
         choices=["REC-P", "REC-PA", "REC-A", "REC-LLM-PA"],
     )
     parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="force deterministic cudnn kernels instead of autotuning them",
+    )
     parser.add_argument("--stage", type=int, default=2, help="one or two stages")
 
     args = parser.parse_args()
@@ -88,14 +124,26 @@ def parse_args():
 
 def T5Trainer(args):
 
-    torch.manual_seed(args.seed)  # pytorch random seed
-    np.random.seed(args.seed)  # numpy random seed
-    torch.backends.cudnn.deterministic = True
+    # seeds data loading and model init, the Trainer re-seeds from
+    # training_args.seed when it is built and when training starts
+    set_seed(args.seed)
+    if args.deterministic:
+        torch.backends.cudnn.deterministic = True
+    else:
+        torch.backends.cudnn.benchmark = True
+    # tf32 for the fp32 matmuls left over by autocast (no-op before Ampere)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # T5 overflows in fp16, so mixed precision is bf16 only
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    # load batches in background workers so the GPU is not left waiting
+    num_workers = min(8, (os.cpu_count() or 1) // 2)
 
     if args.evaluate_dir is not None:
         args.model = args.evaluate_dir
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    tokenizer = AutoTokenizer.from_pretrained(args.model, use_fast=True)
+    assert tokenizer.is_fast, f"{args.model} has no fast tokenizer (tokenizer.json)"
 
     console.log(f"""[Model]: Loading {args.model}...\n""")
     console.log(f"[Data]: Reading data...\n")
@@ -106,12 +154,13 @@ def T5Trainer(args):
         save_dir = (
             f"{args.output_dir}/{args.dataset}-{args.prompt_format}-stage-{args.stage}"
         )
-        if not os.path.exists(save_dir):
-            os.mkdir(save_dir)
+        os.makedirs(save_dir, exist_ok=True)
     print("save_dir:", save_dir)
 
     train_data, val_data, test_data = load_dataset_std(args)
 
+    if args.attn_implementation == "sdpa" and not enable_sdpa_attention():
+        console.log(f"[Model]: torch<2.1, falling back to eager attention\n")
     model = T5ForConditionalGeneration.from_pretrained(args.model)
     train_set = DatasetStd(
         train_data,
@@ -143,30 +192,37 @@ def T5Trainer(args):
 
     # rougel for rationale generation
     metric = evaluate.load("rouge")
+    # keep one punkt tokenizer for postprocess_text instead of going through
+    # nltk.sent_tokenize, whose nltk.data.load lookups are already cached
+    sent_tokenizer = nltk.data.load("tokenizers/punkt/english.pickle")
 
     def postprocess_text(preds, labels):
-        preds = [pred.strip() for pred in preds]
-        labels = [label.strip() for label in labels]
-        preds = ["\n".join(nltk.sent_tokenize(pred)) for pred in preds]
-        labels = ["\n".join(nltk.sent_tokenize(label)) for label in labels]
+        preds = ["\n".join(sent_tokenizer.tokenize(pred.strip())) for pred in preds]
+        labels = ["\n".join(sent_tokenizer.tokenize(label.strip())) for label in labels]
         return preds, labels
 
+    def decode(ids):
+        # one list conversion and one parallel call into the rust tokenizer,
+        # no cleanup regex pass since sentencepiece restores the spacing
+        return tokenizer.backend_tokenizer.decode_batch(
+            ids.tolist(), skip_special_tokens=True
+        )
+
     def compute_metrics_rougel(eval_preds):
         if args.use_generate:
             preds, targets = eval_preds
             if isinstance(preds, tuple):
                 preds = preds[0]
         else:
-            preds = eval_preds.predictions[0]
+            # RecTrainer already reduced the logits to token ids
+            preds = eval_preds.predictions
             targets = eval_preds.label_ids
-            preds = preds.argmax(axis=2)
         preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-        preds = tokenizer.batch_decode(
-            preds, skip_special_tokens=True, clean_up_tokenization_spaces=True
-        )
-        targets = tokenizer.batch_decode(
-            targets, skip_special_tokens=True, clean_up_tokenization_spaces=True
-        )
+        targets = np.where(targets != -100, targets, tokenizer.pad_token_id)
+        # count generated tokens on the id array before it is decoded
+        prediction_lens = np.count_nonzero(preds != tokenizer.pad_token_id, axis=1)
+        preds = decode(preds)
+        targets = decode(targets)
 
         decoded_preds, decoded_labels = postprocess_text(preds, targets)
 
@@ -174,12 +230,44 @@ def T5Trainer(args):
             predictions=decoded_preds, references=decoded_labels, use_stemmer=True
         )
         result = {k: round(v * 100, 4) for k, v in result.items()}
-        prediction_lens = [
-            np.count_nonzero(pred != tokenizer.pad_token_id) for pred in preds
-        ]
         result["gen_len"] = np.mean(prediction_lens)
         return result
 
+    def save_predictions(predict_results, data, split, with_scores=False):
+        # decode the generated preferences, merge them into the split for the
+        # next stage and write pred_pre_{split}.json and {split}_new.json
+        preds, targets = predict_results.predictions, predict_results.label_ids
+        preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
+        targets = np.where(targets != -100, targets, tokenizer.pad_token_id)
+        preds = decode(preds)
+        targets = decode(targets)
+        preds = [pred.strip() for pred in preds]
+
+        for item, pred in zip(data, preds):
+            item["pred_preference"] = pred
+
+        output_data = {}
+        if with_scores:
+            # key by position, str() of every sample dict was costly and only
+            # needs to be unique
+            results_rationale = dict(zip(map(str, range(len(preds))), preds))
+            results_reference = dict(zip(map(str, range(len(targets))), targets))
+            output_data["scores"] = get_scores(results_rationale, results_reference)
+        output_data["preds"] = preds
+        output_data["labels"] = targets
+
+        output_prediction_file = os.path.join(save_dir, f"pred_pre_{split}.json")
+        with open(output_prediction_file, "wb") as writer:
+            writer.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
+
+        preference_file = os.path.join(save_dir, f"{split}_new.json")
+        with open(preference_file, "wb") as writer:
+            writer.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+    # answer formats pick the best model by eval_loss and are never decoded,
+    # so generating during their evaluation would be wasted work
+    predict_with_generate = args.use_generate and "A" not in args.prompt_format
+
     # only use the last model for evaluation to save time
     if args.final_eval:
         training_args = Seq2SeqTrainingArguments(
@@ -194,11 +282,22 @@ def T5Trainer(args):
             learning_rate=args.lr,
             eval_accumulation_steps=args.eval_acc,
             per_device_train_batch_size=args.bs,
+            gradient_accumulation_steps=args.grad_acc,
+            gradient_checkpointing=args.gradient_checkpointing,
             per_device_eval_batch_size=args.eval_bs,
             weight_decay=0.01,
             num_train_epochs=args.epoch,
-            predict_with_generate=args.use_generate,
+            predict_with_generate=predict_with_generate,
             generation_max_length=args.output_len,
+            generation_num_beams=args.num_beams,
+            bf16=use_bf16,
+            bf16_full_eval=use_bf16,
+            torch_compile=args.torch_compile,
+            dataloader_num_workers=num_workers,
+            dataloader_pin_memory=True,
+            group_by_length=True,
+            length_column_name="input_len",
+            seed=args.seed,
             report_to="none",
         )
     # evaluate at each epoch
@@ -215,20 +314,31 @@ def T5Trainer(args):
             learning_rate=args.lr,
             eval_accumulation_steps=args.eval_acc,
             per_device_train_batch_size=args.bs,
+            gradient_accumulation_steps=args.grad_acc,
+            gradient_checkpointing=args.gradient_checkpointing,
             per_device_eval_batch_size=args.eval_bs,
             weight_decay=0.01,
             num_train_epochs=args.epoch,
             metric_for_best_model=(
                 "eval_loss" if "A" in args.prompt_format else "rougeL"
             ),
-            predict_with_generate=args.use_generate,
+            predict_with_generate=predict_with_generate,
             generation_max_length=args.output_len,
+            generation_num_beams=args.num_beams,
             load_best_model_at_end=True,
+            bf16=use_bf16,
+            bf16_full_eval=use_bf16,
+            torch_compile=args.torch_compile,
+            dataloader_num_workers=num_workers,
+            dataloader_pin_memory=True,
+            group_by_length=True,
+            length_column_name="input_len",
+            seed=args.seed,
             report_to="none",
         )
 
     if "A" not in args.prompt_format:
-        trainer = Seq2SeqTrainer(
+        trainer = RecTrainer(
             model=model,
             args=training_args,
             train_dataset=train_set,
@@ -239,7 +349,7 @@ def T5Trainer(args):
             callbacks=[EarlyStoppingCallback(10)],
         )
     else:
-        trainer = Seq2SeqTrainer(
+        trainer = RecTrainer(
             model=model,
             args=training_args,
             train_dataset=train_set,
@@ -254,96 +364,36 @@ def T5Trainer(args):
         trainer.train()
         trainer.save_model(save_dir)
 
-    metrics = trainer.evaluate(eval_dataset=test_set, max_length=args.output_len)
+    metrics = trainer.evaluate(
+        eval_dataset=test_set,
+        max_length=args.output_len,
+        num_beams=args.num_beams,
+        do_sample=False,
+    )
     trainer.log_metrics("test", metrics)
     trainer.save_metrics("test", metrics)
 
     if "A" not in args.prompt_format:
         predict_results = trainer.predict(
-            test_dataset=test_set, max_length=args.output_len
+            test_dataset=test_set,
+            max_length=args.output_len,
+            num_beams=args.num_beams,
+            do_sample=False,
         )
         if trainer.is_world_process_zero():
-            if args.use_generate:
-                preds, targets = predict_results.predictions, predict_results.label_ids
-            else:
-                preds = predict_results.predictions[0]
-                targets = predict_results.label_ids
-                preds = preds.argmax(axis=2)
-
-            preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-            preds = tokenizer.batch_decode(
-                preds, skip_special_tokens=True, clean_up_tokenization_spaces=True
-            )
-            targets = tokenizer.batch_decode(
-                targets, skip_special_tokens=True, clean_up_tokenization_spaces=True
-            )
-
-            results_rationale = {}
-            results_reference = {}
-
-            for idx, qid in enumerate(test_data[:]):
-                pred = preds[int(idx)]
-                ref = targets[int(idx)]
-                test_data[int(idx)]["pred_preference"] = pred
-
-                results_rationale[str(qid)] = pred
-                results_reference[str(qid)] = ref
-
-            scores = get_scores(
-                results_rationale,
-                results_reference,
-            )
-            preds = [pred.strip() for pred in preds]
-            output_data = {
-                "scores": scores,
-                "preds": preds,
-                "labels": targets,
-            }
-            output_prediction_file = os.path.join(save_dir, "pred_pre_test.json")
-            with open(output_prediction_file, "w") as writer:
-                writer.write(json.dumps(output_data, indent=4))
-
-            test_preference = os.path.join(save_dir, "test_new.json")
-            with open(test_preference, "w") as writer:
-                writer.write(json.dumps(test_data, indent=4))
+            save_predictions(predict_results, test_data, "test", with_scores=True)
 
         # generate the preference for the val set
-        if "A" not in args.prompt_format:
-            torch.cuda.empty_cache()
-            del predict_results, preds, targets
-            predict_results = trainer.predict(
-                test_dataset=eval_set, max_length=args.output_len
-            )
-            if trainer.is_world_process_zero():
-                if args.use_generate:
-                    preds, targets = (
-                        predict_results.predictions,
-                        predict_results.label_ids,
-                    )
-                else:
-                    preds = predict_results.predictions[0]
-                    targets = predict_results.label_ids
-                    preds = preds.argmax(axis=2)
-
-                preds = np.where(preds != -100, preds, tokenizer.pad_token_id)
-                preds = tokenizer.batch_decode(
-                    preds, skip_special_tokens=True, clean_up_tokenization_spaces=True
-                )
-                targets = tokenizer.batch_decode(
-                    targets, skip_special_tokens=True, clean_up_tokenization_spaces=True
-                )
-                preds = [pred.strip() for pred in preds]
-                output_data = {"preds": preds, "labels": targets}
-                output_prediction_file = os.path.join(save_dir, "pred_pre_val.json")
-                with open(output_prediction_file, "w") as writer:
-                    writer.write(json.dumps(output_data, indent=4))
-
-                for idx, qid in enumerate(val_data[:]):
-                    pred = preds[int(idx)]
-                    val_data[int(idx)]["pred_preference"] = pred
-                val_preference = os.path.join(save_dir, "val_new.json")
-                with open(val_preference, "w") as writer:
-                    writer.write(json.dumps(val_data, indent=4))
+        del predict_results
+        torch.cuda.empty_cache()
+        predict_results = trainer.predict(
+            test_dataset=eval_set,
+            max_length=args.output_len,
+            num_beams=args.num_beams,
+            do_sample=False,
+        )
+        if trainer.is_world_process_zero():
+            save_predictions(predict_results, val_data, "val")
 
 
 if __name__ == "__main__":
@@ -362,9 +412,6 @@ if __name__ == "__main__":
     print("====Input Arguments====")
     print(json.dumps(vars(args), indent=2, sort_keys=False))
 
-    random.seed(args.seed)  # 设置随机数种子，保证随机数一样
-
-    if not os.path.exists(args.output_dir):
-        os.mkdir(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     T5Trainer(args=args)
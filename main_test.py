@@ -6,6 +6,7 @@ import argparse
 import random
 from transformers import (
     AutoTokenizer,
+    DataCollatorForSeq2Seq,
     T5ForConditionalGeneration,
 )
 from utils_data import load_dataset_std, DatasetStd
@@ -85,6 +86,7 @@ def T5Test(args):
         shuffle=False,
         num_workers=0,
         batch_size=args.eval_bs,
+        collate_fn=DataCollatorForSeq2Seq(tokenizer),
         pin_memory=True,
     )
 
@@ -94,6 +96,7 @@ def T5Test(args):
         with torch.no_grad():
             beam_outputs = model.generate(
                 v["input_ids"].to("cuda"),
+                attention_mask=v["attention_mask"].to("cuda"),
                 max_length=50,
                 num_beams=20,
                 no_repeat_ngram_size=0,
@@ -137,7 +140,6 @@ if __name__ == "__main__":
 
     random.seed(args.seed)  # 设置随机数种子，保证随机数一样
 
-    if not os.path.exists(args.output_dir):
-        os.mkdir(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
     T5Test(args=args)
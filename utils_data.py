@@ -43,39 +43,24 @@ class DatasetStd(Dataset):
             self.target_text.append(target)
             self.source_text.append(prompt)
 
-    def __len__(self):
-        return len(self.target_text)
+        # cleaning data so as to ensure data is in string type
+        source_text = [" ".join(str(text).split()) for text in self.source_text]
+        target_text = [" ".join(str(text).split()) for text in self.target_text]
 
-    def __getitem__(self, index):
-        source_text = str(self.source_text[index])
-        target_text = str(self.target_text[index])
+        # tokenize the whole split once in a single batched call, no padding
+        # here, DataCollatorForSeq2Seq pads each batch to its longest
+        self.source = tokenizer(source_text, max_length=source_len, truncation=True)
+        self.target = tokenizer(target_text, max_length=target_len, truncation=True)
 
-        # cleaning data so as to ensure data is in string type
-        source_text = " ".join(source_text.split())
-        target_text = " ".join(target_text.split())
+        # token length of every source, used to batch inputs of similar length
+        self.input_len = [len(ids) for ids in self.source["input_ids"]]
 
-        source = self.tokenizer.batch_encode_plus(
-            [source_text],
-            max_length=self.source_len,
-            pad_to_max_length=True,
-            truncation=True,
-            padding="max_length",
-            return_tensors="pt",
-        )
-        target = self.tokenizer.batch_encode_plus(
-            [target_text],
-            max_length=self.summ_len,
-            pad_to_max_length=True,
-            truncation=True,
-            padding="max_length",
-            return_tensors="pt",
-        )
-        source_ids = source["input_ids"].squeeze()
-        source_mask = source["attention_mask"].squeeze()
-        target_ids = target["input_ids"].squeeze().tolist()
+    def __len__(self):
+        return len(self.target_text)
 
+    def __getitem__(self, index):
         return {
-            "input_ids": source_ids,
-            "attention_mask": source_mask,
-            "labels": target_ids,
+            "input_ids": self.source["input_ids"][index],
+            "attention_mask": self.source["attention_mask"][index],
+            "labels": self.target["input_ids"][index],
         }
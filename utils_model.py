@@ -0,0 +1,152 @@
+import torch
+import torch.nn.functional as F
+from packaging import version
+from transformers.models.t5.modeling_t5 import T5Attention
+
+_eager_forward = T5Attention.forward
+
+
+def _sdpa_forward(
+    self,
+    hidden_states,
+    mask=None,
+    key_value_states=None,
+    position_bias=None,
+    past_key_value=None,
+    layer_head_mask=None,
+    query_length=None,
+    use_cache=False,
+    output_attentions=False,
+):
+    # attention weights and head masks need the explicit softmax
+    if output_attentions or layer_head_mask is not None:
+        return _eager_forward(
+            self,
+            hidden_states,
+            mask=mask,
+            key_value_states=key_value_states,
+            position_bias=position_bias,
+            past_key_value=past_key_value,
+            layer_head_mask=layer_head_mask,
+            query_length=query_length,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+        )
+
+    batch_size, seq_length = hidden_states.shape[:2]
+
+    real_seq_length = seq_length
+    if past_key_value is not None:
+        if len(past_key_value) != 2:
+            raise ValueError(
+                "past_key_value should have 2 past states: keys and values. "
+                f"Got {len(past_key_value)} past states"
+            )
+        real_seq_length += (
+            past_key_value[0].shape[2] if query_length is None else query_length
+        )
+
+    key_length = (
+        real_seq_length if key_value_states is None else key_value_states.shape[1]
+    )
+
+    def shape(states):
+        return states.view(
+            batch_size, -1, self.n_heads, self.key_value_proj_dim
+        ).transpose(1, 2)
+
+    def unshape(states):
+        return states.transpose(1, 2).contiguous().view(batch_size, -1, self.inner_dim)
+
+    def project(hidden_states, proj_layer, key_value_states, past_key_value):
+        if key_value_states is None:
+            # self-attn
+            hidden_states = shape(proj_layer(hidden_states))
+        elif past_key_value is None:
+            # cross-attn
+            hidden_states = shape(proj_layer(key_value_states))
+
+        if past_key_value is not None:
+            if key_value_states is None:
+                # self-attn
+                hidden_states = torch.cat([past_key_value, hidden_states], dim=2)
+            elif past_key_value.shape[2] != key_value_states.shape[1]:
+                # cross-attn with a prefix of different length
+                hidden_states = shape(proj_layer(key_value_states))
+            else:
+                # cross-attn
+                hidden_states = past_key_value
+        return hidden_states
+
+    query_states = shape(self.q(hidden_states))
+    key_states = project(
+        hidden_states,
+        self.k,
+        key_value_states,
+        past_key_value[0] if past_key_value is not None else None,
+    )
+    value_states = project(
+        hidden_states,
+        self.v,
+        key_value_states,
+        past_key_value[1] if past_key_value is not None else None,
+    )
+
+    if position_bias is None:
+        if not self.has_relative_attention_bias:
+            position_bias = torch.zeros(
+                (1, self.n_heads, real_seq_length, key_length),
+                device=query_states.device,
+                dtype=query_states.dtype,
+            )
+            if self.gradient_checkpointing and self.training:
+                position_bias.requires_grad = True
+        else:
+            position_bias = self.compute_bias(
+                real_seq_length, key_length, device=query_states.device
+            )
+
+        # if key and values are already calculated
+        # we want only the last query position bias
+        if past_key_value is not None:
+            position_bias = position_bias[:, :, -hidden_states.size(1) :, :]
+
+        if mask is not None:
+            # (batch_size, n_heads, seq_length, key_length)
+            position_bias = position_bias + mask
+
+    if self.pruned_heads:
+        mask = torch.ones(position_bias.shape[1])
+        mask[list(self.pruned_heads)] = 0
+        position_bias_masked = position_bias[:, mask.bool()]
+    else:
+        position_bias_masked = position_bias
+
+    # T5 folds the 1/sqrt(d) scaling into its weights, hence scale=1.0
+    attn_output = F.scaled_dot_product_attention(
+        query_states,
+        key_states,
+        value_states,
+        attn_mask=position_bias_masked.to(query_states.dtype),
+        dropout_p=self.dropout if self.training else 0.0,
+        scale=1.0,
+    )
+    attn_output = self.o(unshape(attn_output))
+
+    present_key_value_state = (
+        (key_states, value_states) if (self.is_decoder and use_cache) else None
+    )
+    return (attn_output,) + (present_key_value_state,) + (position_bias,)
+
+
+def enable_sdpa_attention():
+    """
+    Route T5 attention through torch's scaled_dot_product_attention, the
+    relative position bias and padding mask go in as its additive mask so
+    softmax, dropout and the value product run in one fused kernel
+
+    """
+    if version.parse(torch.__version__) < version.parse("2.1"):
+        return False
+    T5Attention.forward = _sdpa_forward
+    return True
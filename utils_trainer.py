@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from transformers import Seq2SeqTrainer
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+
+class LengthSortedSampler(Sampler):
+    """
+    Walks a dataset from its longest to its shortest input so that every
+    evaluation batch holds sequences of similar length
+
+    """
+
+    def __init__(self, lengths):
+        self.indices = sorted(
+            range(len(lengths)), key=lengths.__getitem__, reverse=True
+        )
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def restore(self, array):
+        # put predictions made in sampler order back in dataset order
+        restored = np.empty_like(array)
+        restored[self.indices] = array
+        return restored
+
+
+class RecTrainer(Seq2SeqTrainer):
+    """
+    Seq2SeqTrainer that hands back token ids instead of full logits when
+    predicting without generation, so only [B, T] integers are gathered
+    on the host during evaluation, and that batches inputs by their cached
+    token length when group_by_length is set
+
+    """
+
+    def _get_train_sampler(self):
+        # distributed runs keep the sharded samplers of the base Trainer
+        lengths = getattr(self.train_dataset, self.args.length_column_name, None)
+        if (
+            self.args.group_by_length
+            and lengths is not None
+            and self.args.world_size <= 1
+        ):
+            # same seed choice as the base Trainer, main.py passes --seed
+            # through to training_args.seed
+            generator = torch.Generator()
+            generator.manual_seed(
+                self.args.data_seed
+                if self.args.data_seed is not None
+                else self.args.seed
+            )
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=lengths,
+                generator=generator,
+            )
+        return super()._get_train_sampler()
+
+    def _get_eval_sampler(self, eval_dataset):
+        lengths = getattr(eval_dataset, self.args.length_column_name, None)
+        if (
+            self.args.group_by_length
+            and lengths is not None
+            and self.args.world_size <= 1
+        ):
+            return LengthSortedSampler(lengths)
+        return super()._get_eval_sampler(eval_dataset)
+
+    def predict(
+        self, test_dataset, ignore_keys=None, metric_key_prefix="test", **gen_kwargs
+    ):
+        output = super().predict(
+            test_dataset,
+            ignore_keys=ignore_keys,
+            metric_key_prefix=metric_key_prefix,
+            **gen_kwargs,
+        )
+        sampler = self._get_eval_sampler(test_dataset)
+        if isinstance(sampler, LengthSortedSampler):
+            output = output._replace(
+                predictions=sampler.restore(output.predictions),
+                label_ids=sampler.restore(output.label_ids),
+            )
+        return output
+
+    def prediction_step(
+        self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs
+    ):
+        loss, logits, labels = super().prediction_step(
+            model,
+            inputs,
+            prediction_loss_only,
+            ignore_keys=ignore_keys,
+            **gen_kwargs,
+        )
+        if self.args.predict_with_generate or logits is None:
+            return loss, logits, labels
+
+        # drop encoder states and keep the lm logits only
+        if isinstance(logits, tuple):
+            logits = logits[0]
+        preds = logits.argmax(dim=-1).to(torch.int32)
+        # labels are padded with -100 per batch, blank the argmax past them so
+        # tokens after the end of a shorter label are not decoded
+        if labels is not None:
+            preds = preds.masked_fill(labels == -100, self.tokenizer.pad_token_id)
+        return loss, preds, labels